@@ -1,8 +1,11 @@
 """
 BitBake 'Fetch' implementation for Amazon AWS S3.
 
-Class for fetching files from Amazon S3 using the AWS Command Line Interface.
-The aws tool must be correctly installed and configured prior to use.
+Class for fetching files from Amazon S3 using the boto3 Python client
+where available, falling back to the AWS Command Line Interface. One of
+the two must be correctly installed and configured prior to use.
+Setting FETCHCMD_s3 always selects the command line tool, e.g. to pass
+--endpoint-url for a non-AWS S3 service.
 
 """
 
@@ -15,52 +18,257 @@ The aws tool must be correctly installed and configured prior to use.
 #
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 
+import atexit
 import os
+import posixpath
 import bb
 import urllib.request, urllib.parse, urllib.error
-import re
+import threading
+import time
 from bb.fetch2 import FetchMethod
 from bb.fetch2 import FetchError
+from bb.fetch2 import logger
 from bb.fetch2 import runfetchcmd
 
+try:
+    import boto3
+    import boto3.exceptions
+    import botocore.config
+    import botocore.exceptions
+    import s3transfer.exceptions
+    from boto3.s3.transfer import TransferConfig
+except ImportError:
+    boto3 = None
+else:
+    # Everything a transfer can raise that should soft-fail the fetch so
+    # that mirror fallback still runs: service errors (ClientError),
+    # client-side/network errors (BotoCoreError covers endpoint, connect
+    # and read timeouts) and the transfer managers' own wrappers
+    _BOTO_ERRORS = (botocore.exceptions.ClientError,
+                    botocore.exceptions.BotoCoreError,
+                    boto3.exceptions.Boto3Error,
+                    s3transfer.exceptions.RetriesExceededError,
+                    s3transfer.exceptions.TransferNotDoneError)
+
+try:
+    from s3transfer.processpool import ProcessPoolDownloader, ProcessTransferConfig
+except ImportError:
+    ProcessPoolDownloader = None
+
+# Objects at least this large are handed to a pool of worker processes,
+# which sidesteps the GIL limiting thread-based transfers; below it the
+# process spawn overhead isn't worth paying.
+_PROCESS_POOL_THRESHOLD = 256 * 1024 * 1024
+
+# Shared across transfers so worker processes are only spawned once
+_process_pool = None
+_process_pool_lock = threading.Lock()
+
+def _get_process_pool(d):
+    """
+    Return the shared s3transfer ProcessPoolDownloader. Setting
+    BB_S3_MAX_PROCS (the number of worker processes) is what opts
+    downloads in to the pool in the first place.
+    """
+    global _process_pool
+    if _process_pool is None:
+        with _process_pool_lock:
+            if _process_pool is None:
+                config = ProcessTransferConfig(
+                    multipart_threshold=8 * 1024 * 1024,
+                    multipart_chunksize=16 * 1024 * 1024,
+                    max_request_processes=int(d.getVar("BB_S3_MAX_PROCS") or 8))
+                client_kwargs = {}
+                region = d.getVar("AWS_DEFAULT_REGION")
+                if region:
+                    client_kwargs["region_name"] = region
+                _process_pool = ProcessPoolDownloader(client_kwargs=client_kwargs, config=config)
+    return _process_pool
+
+def _shutdown_process_pool():
+    global _process_pool
+    if _process_pool is not None:
+        _process_pool.shutdown()
+        _process_pool = None
+
+# The pool's worker processes outlive individual transfers by design;
+# join them when the interpreter exits rather than leaking them
+atexit.register(_shutdown_process_pool)
+
+# Client construction is expensive (service model load, endpoint
+# resolution), so one tuned client is shared by every S3 url
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+def _reset_after_fork():
+    global _s3_client
+    global _process_pool
+    _s3_client = None
+    # The inherited pool handle refers to worker processes and queues
+    # owned by the parent; forget it so the child builds its own
+    _process_pool = None
+
+# The client holds sockets and locks which don't survive BitBake's
+# fork-based worker split; have children rebuild both it and the
+# process pool lazily
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+def _get_client(d):
+    """
+    Return the shared boto3 S3 client, creating it on first use with a
+    connection pool sized for BB_S3_MAX_CONCURRENCY and adaptive retries.
+    """
+    global _s3_client
+    if _s3_client is None:
+        with _s3_client_lock:
+            if _s3_client is None:
+                concurrency = int(d.getVar("BB_S3_MAX_CONCURRENCY") or 10)
+                config = botocore.config.Config(
+                    max_pool_connections=max(10, concurrency),
+                    retries={"mode": "adaptive", "max_attempts": 10})
+                _s3_client = boto3.client('s3', config=config)
+    return _s3_client
+
+# Status checks are amortized by listing a whole (bucket, prefix) once
+# and answering subsequent probes for neighbouring keys from the cache,
+# evicting the oldest listings beyond the bound
+_list_cache = {}
+_LIST_CACHE_MAX = 128
+
+# Shared by all transfers; constructed lazily so the datastore can tune it
+_transfer_config = None
+_transfer_config_lock = threading.Lock()
+
+def _get_transfer_config(d):
+    """
+    Return the shared boto3 TransferConfig, enabling concurrent byte-range
+    GETs so large objects aren't limited to a single connection. Tunable
+    via BB_S3_MAX_CONCURRENCY and BB_S3_MULTIPART_CHUNKSIZE.
+    """
+    global _transfer_config
+    if _transfer_config is None:
+        with _transfer_config_lock:
+            if _transfer_config is None:
+                chunksize = int(d.getVar("BB_S3_MULTIPART_CHUNKSIZE") or 8 * 1024 * 1024)
+                _transfer_config = TransferConfig(
+                    multipart_threshold=8 * 1024 * 1024,
+                    multipart_chunksize=chunksize,
+                    max_concurrency=int(d.getVar("BB_S3_MAX_CONCURRENCY") or 10),
+                    use_threads=True)
+    return _transfer_config
+
+# Multipliers for the size units aws s3 cp reports progress in; sizes
+# below one KiB are printed as "Byte"/"Bytes" rather than a bare "B"
+_UNIT = {
+    "Byte": 1,
+    "Bytes": 1,
+    "B": 1,
+    "KiB": 1024,
+    "MiB": 1024 ** 2,
+    "GiB": 1024 ** 3,
+    "TiB": 1024 ** 4,
+    "PiB": 1024 ** 5,
+    "EiB": 1024 ** 6,
+}
+
 def convertToBytes(value, unit):
-    value = float(value)
-    if (unit == "KiB"):
-        value = value*1024.0;
-    elif (unit == "MiB"):
-        value = value*1024.0*1024.0;
-    elif (unit == "GiB"):
-        value = value*1024.0*1024.0*1024.0;
-    return value
+    return float(value) * _UNIT.get(unit, 1)
+
+def _use_boto(d):
+    """
+    Whether to fetch with the boto3 client rather than the command line
+    tool. An explicitly configured FETCHCMD_s3 (e.g. aws with
+    --endpoint-url pointing at minio or ceph) must keep being run as-is,
+    so boto3 is only preferred for the default aws invocation.
+    """
+    return boto3 is not None and not d.getVar("FETCHCMD_s3")
 
 class S3ProgressHandler(bb.progress.LineFilterProgressHandler):
     """
     Extract progress information from s3 cp output, e.g.:
     Completed 5.1 KiB/8.8 GiB (12.0 MiB/s) with 1 file(s) remaining
     """
-    def __init__(self, d):
-        super(S3ProgressHandler, self).__init__(d)
+    def __init__(self, d, outfile=None):
+        super(S3ProgressHandler, self).__init__(d, outfile)
         # Send an initial progress event so the bar gets shown
         self._fire_progress(0)
 
     def writeline(self, line):
-        percs = re.findall(r'^Completed (\d+.{0,1}\d*) (\w+)\/(\d+.{0,1}\d*) (\w+) (\(.+\)) with\s+', line)
-        if percs:
-            completed = (percs[-1][0])
-            completedUnit = (percs[-1][1])
-            total = (percs[-1][2])
-            totalUnit = (percs[-1][3])
-            completed = convertToBytes(completed, completedUnit)
-            total = convertToBytes(total, totalUnit)
-            progress = (completed/total)*100.0
-            rate = percs[-1][4]
-            self.update(progress, rate)
+        # Cheap substring gate; most lines aren't progress updates
+        if not line.startswith('Completed '):
+            return True
+        # Tokenize "5.1 KiB/8.8 GiB (12.0 MiB/s) with ..." with plain
+        # string splits; this runs per progress tick and has none of the
+        # regex engine's per-line cost
+        done, sep, rest = line[10:].partition('/')
+        if not sep:
+            return True
+        total, sep, rest = rest.partition(' (')
+        if not sep:
+            return True
+        rate, sep, _ = rest.partition(') with')
+        if not sep:
+            return True
+        try:
+            value, unit = done.split()
+            completed = float(value) * _UNIT[unit]
+            value, unit = total.split()
+            total = float(value) * _UNIT[unit]
+        except (ValueError, KeyError):
+            return True
+        if total:
+            self.update((completed/total)*100.0, '(%s)' % rate)
             return False
         return True
 
 
+class BotoProgress:
+    """
+    Translate boto3 transfer callbacks into task progress events. The
+    callbacks only carry a byte delta, so the total size is supplied up
+    front where known.
+    """
+    # Fire at most this often; boto3 invokes the callback per chunk from
+    # several transfer threads and the UI can't consume updates that fast
+    _MIN_FIRE_INTERVAL = 0.1
+
+    def __init__(self, d, size=None):
+        self._data = d
+        self._size = size
+        self._downloaded = 0
+        self._last_time = time.time()
+        self._last_size = 0
+        self._last_fire_time = 0
+        self._lock = threading.Lock()
+        # Send an initial progress event so the bar gets shown
+        bb.event.fire(bb.build.TaskProgress(0), self._data)
+
+    def progress_update(self, bytes_amount):
+        # The lock keeps the counters coherent between transfer threads
+        # and makes the rate-limit decision race-free
+        with self._lock:
+            self._downloaded += bytes_amount
+            now = time.time()
+            finished = self._size is not None and self._downloaded >= self._size
+            if not finished and now - self._last_fire_time < self._MIN_FIRE_INTERVAL:
+                return
+            self._last_fire_time = now
+            rate = None
+            if now > self._last_time:
+                rate = "%.1f MiB/s" % ((self._downloaded - self._last_size) / (now - self._last_time) / (1024 * 1024))
+                self._last_time = now
+                self._last_size = self._downloaded
+            if self._size:
+                progress = min(self._downloaded * 100.0 / self._size, 100)
+            else:
+                # Without a known total the bar can't advance, but the rate
+                # still shows that the transfer is alive
+                progress = 0
+        bb.event.fire(bb.build.TaskProgress(progress, rate), self._data)
+
+
 class S3(FetchMethod):
-    """Class to fetch urls via 'aws s3'"""
+    """Class to fetch urls via boto3 or 'aws s3'"""
 
     def supports(self, ud, d):
         """
@@ -81,28 +289,115 @@ class S3(FetchMethod):
 
         ud.basecmd = d.getVar("FETCHCMD_s3") or "/usr/bin/env aws s3"
 
+    def _boto_download(self, ud, d):
+        """
+        Fetch a url via the boto3 client, using multipart ranged GETs so
+        large objects download over several connections in parallel.
+        """
+        client = _get_client(d)
+        key = ud.path.lstrip("/")
+        # The object size is only needed to route large objects to the
+        # process pool and to scale the (advisory) progress bar; the GET
+        # carries Content-Length anyway, so by default skip the extra
+        # HEAD round-trip per download. Setting BB_S3_MAX_PROCS opts in
+        # to process pool routing, which needs the size up front.
+        size = None
+        if ProcessPoolDownloader and d.getVar("BB_S3_MAX_PROCS"):
+            try:
+                size = client.head_object(Bucket=ud.host, Key=key)["ContentLength"]
+            except _BOTO_ERRORS as e:
+                raise FetchError("Unable to fetch s3://%s%s: %s" % (ud.host, ud.path, e))
+            if size >= _PROCESS_POOL_THRESHOLD:
+                return self._boto_download_pp(ud, d, size)
+        progress = BotoProgress(d, size)
+        try:
+            client.download_file(ud.host, key, ud.localpath,
+                                 Callback=progress.progress_update,
+                                 Config=_get_transfer_config(d))
+        except _BOTO_ERRORS as e:
+            raise FetchError("Unable to fetch s3://%s%s: %s" % (ud.host, ud.path, e))
+
+    def _boto_download_pp(self, ud, d, size):
+        """
+        Fetch a url with s3transfer's process pool downloader, which gives
+        true parallelism for multi-GB objects. The pool doesn't support
+        progress callbacks, so no progress events are fired here.
+        """
+        logger.debug2("Downloading s3://%s%s via process pool (%d bytes)" % (ud.host, ud.path, size))
+        try:
+            _get_process_pool(d).download_file(bucket=ud.host, key=ud.path.lstrip("/"),
+                                               filename=ud.localpath,
+                                               expected_size=size).result()
+        except _BOTO_ERRORS as e:
+            raise FetchError("Unable to fetch s3://%s%s: %s" % (ud.host, ud.path, e))
+
     def download(self, ud, d):
         """
         Fetch urls
         Assumes localpath was called first
         """
 
-        cmd = '%s cp s3://%s%s %s' % (ud.basecmd, ud.host, ud.path, ud.localpath)
-        bb.fetch2.check_network_access(d, cmd, ud.url)
+        if _use_boto(d):
+            bb.fetch2.check_network_access(d, "s3 cp s3://%s%s" % (ud.host, ud.path), ud.url)
+            self._boto_download(ud, d)
+        else:
+            cmd = '%s cp s3://%s%s %s' % (ud.basecmd, ud.host, ud.path, ud.localpath)
+            bb.fetch2.check_network_access(d, cmd, ud.url)
 
-        progresshandler = S3ProgressHandler(d)
-        runfetchcmd(cmd, d, False, log=progresshandler)
+            progresshandler = S3ProgressHandler(d)
+            runfetchcmd(cmd, d, False, log=progresshandler)
 
         # Additional sanity checks copied from the wget class (although there
-        # are no known issues which mean these are required, treat the aws cli
-        # tool with a little healthy suspicion).
+        # are no known issues which mean these are required, treat the
+        # download tool with a little healthy suspicion).
 
-        if not os.path.exists(ud.localpath):
-            raise FetchError("The aws cp command returned success for s3://%s%s but %s doesn't exist?!" % (ud.host, ud.path, ud.localpath))
+        try:
+            st = os.stat(ud.localpath)
+        except FileNotFoundError:
+            raise FetchError("The s3 fetch returned success for s3://%s%s but %s doesn't exist?!" % (ud.host, ud.path, ud.localpath))
 
-        if os.path.getsize(ud.localpath) == 0:
+        if st.st_size == 0:
             os.remove(ud.localpath)
-            raise FetchError("The aws cp command for s3://%s%s resulted in a zero size file?! Deleting and failing since this isn't right." % (ud.host, ud.path))
+            raise FetchError("The s3 fetch of s3://%s%s resulted in a zero size file?! Deleting and failing since this isn't right." % (ud.host, ud.path))
+
+        return True
+
+    def _boto_checkstatus(self, ud, d):
+        """
+        Check for a key by paginating list_objects_v2 over its prefix and
+        caching the result, so many SRC_URIs sharing a bucket/prefix cost
+        one LIST instead of a request each.
+        """
+        key = ud.path.lstrip("/")
+        prefix = posixpath.dirname(key)
+        if not prefix:
+            # A top-level key has no directory component to list, and
+            # Prefix="" would pull down the entire bucket just to answer
+            # one probe; a single HEAD is the cheaper option there
+            try:
+                _get_client(d).head_object(Bucket=ud.host, Key=key)
+            except _BOTO_ERRORS as e:
+                raise FetchError("The object s3://%s%s does not exist: %s" % (ud.host, ud.path, e))
+            return True
+
+        cachekey = (ud.host, prefix)
+        keys = _list_cache.get(cachekey)
+        if keys is None:
+            keys = set()
+            try:
+                paginator = _get_client(d).get_paginator('list_objects_v2')
+                for page in paginator.paginate(Bucket=ud.host, Prefix=prefix):
+                    for obj in page.get('Contents', []):
+                        keys.add(obj['Key'])
+            except _BOTO_ERRORS as e:
+                raise FetchError("Unable to list s3://%s/%s: %s" % (ud.host, prefix, e))
+            if len(_list_cache) >= _LIST_CACHE_MAX:
+                # Dicts iterate in insertion order, so this is the oldest
+                _list_cache.pop(next(iter(_list_cache)))
+            _list_cache[cachekey] = keys
+
+        if key not in keys:
+            raise FetchError("The object s3://%s%s does not exist" % (ud.host, ud.path))
 
         return True
 
@@ -113,6 +408,10 @@ class S3(FetchMethod):
 
         cmd = '%s ls s3://%s%s' % (ud.basecmd, ud.host, ud.path)
         bb.fetch2.check_network_access(d, cmd, ud.url)
+
+        if _use_boto(d):
+            return self._boto_checkstatus(ud, d)
+
         output = runfetchcmd(cmd, d)
 
         # "aws s3 ls s3://mybucket/foo" will exit with success even if the file
@@ -14,12 +14,14 @@ File parsers for the BitBake build tools.
 # Based on functions from the base bb module, Copyright 2003 Holger Schurig
 #
 
-handlers = []
+handlers = ()
 
+import collections
 import errno
+import functools
 import logging
 import os
-import stat
+import sys
 import bb
 import bb.utils
 import bb.siggen
@@ -47,22 +49,53 @@ class SkipPackage(SkipRecipe):
     """Exception raised to skip this recipe (use SkipRecipe in new code)"""
 
 __mtime_cache = {}
+# Directories whose entries have already been batch-scanned into __mtime_cache
+__dir_cache = set()
+
+def __scan_dir_mtimes(f):
+    """
+    Populate __mtime_cache for every entry in f's directory with a single
+    scandir pass. Parsing stats many files per directory, so this replaces
+    one syscall per file with one scan per directory.
+    """
+    dirname = os.path.dirname(f)
+    if dirname in __dir_cache:
+        return
+    __dir_cache.add(dirname)
+    try:
+        with os.scandir(dirname or '.') as entries:
+            for entry in entries:
+                try:
+                    mtime = entry.stat().st_mtime
+                except OSError:
+                    continue
+                __mtime_cache.setdefault(os.path.join(dirname, entry.name), mtime)
+    except OSError:
+        pass
+
+def __stat_mtime(f):
+    return os.stat(f).st_mtime
+
 def cached_mtime(f):
     if f not in __mtime_cache:
-        __mtime_cache[f] = os.stat(f)[stat.ST_MTIME]
+        __scan_dir_mtimes(f)
+        if f not in __mtime_cache:
+            __mtime_cache[f] = __stat_mtime(f)
     return __mtime_cache[f]
 
 def cached_mtime_noerror(f):
     if f not in __mtime_cache:
-        try:
-            __mtime_cache[f] = os.stat(f)[stat.ST_MTIME]
-        except OSError:
-            return 0
+        __scan_dir_mtimes(f)
+        if f not in __mtime_cache:
+            try:
+                __mtime_cache[f] = __stat_mtime(f)
+            except OSError:
+                return 0
     return __mtime_cache[f]
 
 def check_mtime(f, mtime):
     try:
-        current_mtime = os.stat(f)[stat.ST_MTIME]
+        current_mtime = __stat_mtime(f)
         __mtime_cache[f] = current_mtime
     except OSError:
         current_mtime = 0
@@ -70,7 +103,7 @@ def check_mtime(f, mtime):
 
 def update_mtime(f):
     try:
-        __mtime_cache[f] = os.stat(f)[stat.ST_MTIME]
+        __mtime_cache[f] = __stat_mtime(f)
     except OSError:
         if f in __mtime_cache:
             del __mtime_cache[f]
@@ -84,51 +117,136 @@ def update_cache(f):
 
 def clear_cache():
     global __mtime_cache
+    global __dir_cache
+    global __cwd
     __mtime_cache = {}
+    __dir_cache = set()
+    __cwd = None
+    __dep_cache.clear()
+    _which_cached.cache_clear()
+
+def _get_deps(d):
+    """
+    Return the current __depends list and a set mirroring it for O(1)
+    membership tests. The datastore defensively copies mutable values on
+    every read, so the set is stored wrapped in a tuple, which passes
+    through copy.copy by identity and keeps one live set per datastore.
+    It is rebuilt whenever it no longer matches the list, covering the
+    list being replaced externally (e.g. the __depends -> __base_depends
+    rename between the base configuration and recipe parsing) and sets
+    shared with datastore copies that have since diverged.
+    """
+    deps = d.getVar('__depends', False)
+    if deps is None:
+        deps = []
+    wrapper = d.getVar('__depends_set', False)
+    if wrapper is None or len(wrapper[0]) != len(deps):
+        wrapper = (set(deps),)
+        d.setVar('__depends_set', wrapper)
+    return deps, wrapper[0]
+
+# BitBake doesn't change directory while parsing, so one getcwd syscall
+# can serve every relative dependency; clear_cache invalidates it
+__cwd = None
+
+# Thousands of recipes depend on the same shared conf/class files; keep a
+# single canonical record per (file, mtime) so their __depends lists share
+# objects instead of each holding duplicate strings and tuples
+__dep_cache = {}
 
 def mark_dependency(d, f):
+    global __cwd
     if f.startswith('./'):
-        f = "%s/%s" % (os.getcwd(), f[2:])
-    deps = (d.getVar('__depends', False) or [])
-    s = (f, cached_mtime_noerror(f))
-    if s not in deps:
+        if __cwd is None:
+            __cwd = os.getcwd()
+        f = "%s/%s" % (__cwd, f[2:])
+    deps, deps_set = _get_deps(d)
+    s = (sys.intern(f), cached_mtime_noerror(f))
+    s = __dep_cache.setdefault(s, s)
+    if s not in deps_set:
         deps.append(s)
+        deps_set.add(s)
         d.setVar('__depends', deps)
 
 def check_dependency(d, f):
     s = (f, cached_mtime_noerror(f))
-    deps = (d.getVar('__depends', False) or [])
-    return s in deps
+    deps, deps_set = _get_deps(d)
+    return s in deps_set
    
+Handler = collections.namedtuple("Handler", ["supports", "handle", "init", "extensions",
+                                             "needs_inchistory"])
+
+# Most handlers key purely off the file extension, so map extension to
+# handler once and skip the supports() loop on the common path
+__ext_handlers = {}
+
+def add_handler(handler):
+    """
+    Register a parser. handler is a dict with 'supports', 'handle' and
+    'init' callables, plus an optional 'extensions' tuple naming the file
+    extensions the handler supports, enabling direct dispatch. Handlers
+    which never read the file can set 'needs_inchistory' to False to skip
+    include history tracking.
+    """
+    global handlers
+    h = Handler(handler['supports'], handler['handle'], handler.get('init'),
+                handler.get('extensions'), handler.get('needs_inchistory', True))
+    handlers = handlers + (h,)
+    for ext in h.extensions or ():
+        __ext_handlers[ext] = h
+
+def _handler_for(fn):
+    idx = fn.rfind('.')
+    if idx > 0:
+        return __ext_handlers.get(fn[idx:])
+    return None
+
 def supports(fn, data):
     """Returns true if we have a handler for this file, false otherwise"""
+    if _handler_for(fn) is not None:
+        return 1
     for h in handlers:
-        if h['supports'](fn, data):
+        if h.supports(fn, data):
             return 1
     return 0
 
 def handle(fn, data, include=0, baseconfig=False):
     """Call the handler that is appropriate for this file"""
-    for h in handlers:
-        if h['supports'](fn, data):
-            with data.inchistory.include(fn):
-                return h['handle'](fn, data, include, baseconfig)
-    raise ParseError("not a BitBake file", fn)
+    h = _handler_for(fn)
+    if h is None:
+        for candidate in handlers:
+            if candidate.supports(fn, data):
+                h = candidate
+                break
+        else:
+            raise ParseError("not a BitBake file", fn)
+    if h.needs_inchistory:
+        with data.inchistory.include(fn):
+            return h.handle(fn, data, include, baseconfig)
+    return h.handle(fn, data, include, baseconfig)
 
 def init(fn, data):
     for h in handlers:
-        if h['supports'](fn):
-            return h['init'](data)
+        if h.supports(fn):
+            return h.init(data)
 
 def init_parser(d):
     if hasattr(bb.parse, "siggen"):
         bb.parse.siggen.exit()
     bb.parse.siggen = bb.siggen.init(d)
 
+# BBPATH is effectively constant for the duration of a parse pass, so the
+# same relative name resolves to the same file; cache the directory walk.
+# Dependencies are still marked per call by resolve_file below, since they
+# are recorded against each recipe's datastore.
+@functools.lru_cache(maxsize=8192)
+def _which_cached(bbpath, fn):
+    return bb.utils.which(bbpath, fn, history=True)
+
 def resolve_file(fn, d):
     if not os.path.isabs(fn):
         bbpath = d.getVar("BBPATH")
-        newfn, attempts = bb.utils.which(bbpath, fn, history=True)
+        newfn, attempts = _which_cached(bbpath, fn)
         for af in attempts:
             mark_dependency(d, af)
         if not newfn:
@@ -147,20 +265,17 @@ __pkgsplit_cache__={}
 def vars_from_file(mypkg, d):
     if not mypkg or not mypkg.endswith((".bb", ".bbappend")):
         return (None, None, None)
-    if mypkg in __pkgsplit_cache__:
-        return __pkgsplit_cache__[mypkg]
+    # Keyed by basename so recipes sharing a file name share one entry
+    name = os.path.basename(mypkg)
+    cached = __pkgsplit_cache__.get(name)
+    if cached is not None:
+        return cached
 
-    myfile = os.path.splitext(os.path.basename(mypkg))
-    parts = myfile[0].split('_')
-    __pkgsplit_cache__[mypkg] = parts
+    parts = os.path.splitext(name)[0].split('_')
     if len(parts) > 3:
         raise ParseError("Unable to generate default variables from filename (too many underscores)", mypkg)
-    exp = 3 - len(parts)
-    tmplist = []
-    while exp != 0:
-        exp -= 1
-        tmplist.append(None)
-    parts.extend(tmplist)
+    parts = tuple(parts) + (None,) * (3 - len(parts))
+    __pkgsplit_cache__[name] = parts
     return parts
 
 def get_file_depends(d):
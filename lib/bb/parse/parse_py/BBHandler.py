@@ -282,6 +282,7 @@ def feeder(lineno, s, fn, root, statements, eof=False):
     return ConfHandler.feeder(lineno, s, fn, statements, conffile=False)
 
 # Add us to the handlers list
-from .. import handlers
-handlers.append({'supports': supports, 'handle': handle, 'init': init})
-del handlers
+from .. import add_handler
+add_handler({'supports': supports, 'handle': handle, 'init': init,
+             'extensions': (".bb", ".bbclass", ".inc")})
+del add_handler
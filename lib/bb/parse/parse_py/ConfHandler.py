@@ -200,6 +200,7 @@ def feeder(lineno, s, fn, statements, baseconfig=False, conffile=True):
     raise ParseError("unparsed line: '%s'" % s, fn, lineno);
 
 # Add us to the handlers list
-from bb.parse import handlers
-handlers.append({'supports': supports, 'handle': handle, 'init': init})
-del handlers
+from bb.parse import add_handler
+add_handler({'supports': supports, 'handle': handle, 'init': init,
+             'extensions': (".conf",)})
+del add_handler
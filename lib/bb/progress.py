@@ -91,18 +91,19 @@ class LineFilterProgressHandler(ProgressHandler):
 
     def write(self, string):
         self._linebuffer += string
-        while True:
-            breakpos = self._linebuffer.find('\n') + 1
-            if breakpos == 0:
-                # for the case when the line with progress ends with only '\r'
-                breakpos = self._linebuffer.find('\r') + 1
-                if breakpos == 0:
-                    break
-            line = self._linebuffer[:breakpos]
-            self._linebuffer = self._linebuffer[breakpos:]
+        # Find the last terminator ('\n', or '\r' for the case when the
+        # line with progress ends with only '\r') so everything before it
+        # can be split in a single pass, keeping the remainder buffered
+        # rather than rescanning it on every write
+        breakpos = max(self._linebuffer.rfind('\n'), self._linebuffer.rfind('\r')) + 1
+        if breakpos == 0:
+            return
+        complete = self._linebuffer[:breakpos]
+        self._linebuffer = self._linebuffer[breakpos:]
+        for line in complete.splitlines(True):
             # Drop any line feeds and anything that precedes them
             lbreakpos = line.rfind('\r') + 1
-            if lbreakpos and lbreakpos != breakpos:
+            if lbreakpos and lbreakpos != len(line):
                 line = line[lbreakpos:]
             if self.writeline(filter_color(line)):
                 super().write(line)
@@ -7,6 +7,7 @@
 #
 
 import contextlib
+import io
 import unittest
 import hashlib
 import tempfile
@@ -17,6 +18,9 @@ import tarfile
 from bb.fetch2 import URI
 from bb.fetch2 import FetchMethod
 import bb
+import bb.data
+import bb.event
+import bb.fetch2.s3
 from bb.tests.support.httpserver import HTTPService
 
 def skipIfNoNetwork():
@@ -1401,6 +1405,59 @@ class URLHandle(unittest.TestCase):
             result = bb.fetch.encodeurl(v)
             self.assertEqual(result, k)
 
+class S3ProgressHandlerTest(unittest.TestCase):
+    """Parsing of aws s3 cp progress lines, without needing boto or the CLI"""
+
+    class ProgressWatcher:
+        def __init__(self):
+            self.reports = []
+
+        def handle_event(self, event, d):
+            self.reports.append((event.progress, event.rate))
+
+    def setUp(self):
+        self.d = bb.data.init()
+        self.watcher = self.ProgressWatcher()
+        bb.event.register("bb.build.TaskProgress", self.watcher.handle_event, data=self.d)
+        self.buffer = io.StringIO()
+        self.handler = bb.fetch2.s3.S3ProgressHandler(self.d, self.buffer)
+
+    def tearDown(self):
+        bb.event.remove("bb.build.TaskProgress", None)
+
+    def test_progress_line(self):
+        self.handler.write("Completed 5.1 KiB/8.8 GiB (12.0 MiB/s) with 1 file(s) remaining\n")
+        # The constructor fires an initial 0% event so the bar gets shown
+        self.assertEqual(len(self.watcher.reports), 2)
+        progress, rate = self.watcher.reports[1]
+        self.assertAlmostEqual(progress, (5.1 * 1024) / (8.8 * 1024 ** 3) * 100)
+        self.assertEqual(rate, "(12.0 MiB/s)")
+        # Progress lines are consumed, not passed through to the log
+        self.assertEqual(self.buffer.getvalue(), "")
+
+    def test_progress_line_bytes(self):
+        # Sizes below one KiB are reported as "Bytes" (or "1 Byte")
+        self.handler.write("Completed 145 Bytes/290 Bytes (1.1 KiB/s) with 1 file(s) remaining\n")
+        self.handler.write("Completed 1 Byte/4 Bytes (4 Bytes/s) with 1 file(s) remaining\n")
+        self.assertEqual(self.watcher.reports[1:], [(50.0, "(1.1 KiB/s)"), (25.0, "(4 Bytes/s)")])
+        self.assertEqual(self.buffer.getvalue(), "")
+
+    def test_non_progress_lines_pass_through(self):
+        lines = [
+            "download: s3://bucket/file to file\n",
+            "Completed something unexpected\n",
+            "Completed 5.1 XiB/8.8 GiB (12.0 MiB/s) with 1 file(s) remaining\n",
+        ]
+        for line in lines:
+            self.handler.write(line)
+        self.assertEqual(self.watcher.reports[1:], [])
+        self.assertEqual(self.buffer.getvalue(), "".join(lines))
+
+    def test_convert_to_bytes(self):
+        self.assertEqual(bb.fetch2.s3.convertToBytes("145", "Bytes"), 145)
+        self.assertEqual(bb.fetch2.s3.convertToBytes("2.5", "MiB"), 2.5 * 1024 ** 2)
+        self.assertEqual(bb.fetch2.s3.convertToBytes("1", "EiB"), 1024 ** 6)
+
 class FetchLatestVersionTest(FetcherTest):
 
     test_git_uris = {